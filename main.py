@@ -1,38 +1,103 @@
-import base64
+import asyncio
 import json
 from datetime import datetime, timezone
 
 import aiohttp
 
+try:
+    import orjson
+except ImportError:  # orjson 可选，没有就退回标准库
+    orjson = None
+
 from astrbot.api import logger
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
 
 from astrbot.core.utils.session_waiter import session_waiter, SessionController
 
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# 触发词 -> 处理方法名；不带斜杠的“授权”受 allow_plain_trigger 控制
+_DISPATCH = {
+    "授权": "_run_flow",
+    "/授权": "_run_flow",
+    "license": "_run_flow",
+    "auth": "_run_flow",
+}
+_PLAIN_TRIGGER = "授权"
+
+
+def _preview(raw: bytes, limit: int = 300) -> str:
+    # 先截字节再解码，避免把整个大响应体解成字符串
+    return raw[:limit].decode("utf-8", "replace")
+
+
+# 响应体上限：解析在事件循环线程上同步进行，别让上游塞个大包进来卡住
+_MAX_RESP_BYTES = 64 * 1024
+
+
+async def _read_at_most(stream: aiohttp.StreamReader, limit: int) -> bytes:
+    # StreamReader.read(n) 可能只返回已缓冲的部分，循环读到 EOF 或够 limit 为止
+    buf = bytearray()
+    while len(buf) < limit:
+        chunk = await stream.read(limit - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+    return bytes(buf)
+
+
+def _message_text(e: AstrMessageEvent) -> str:
+    # 去掉首尾空白的消息文本，算一次后挂在事件上复用
+    text = getattr(e, "_stripped_msg", None)
+    if text is None:
+        text = (e.message_str or "").strip()
+        try:
+            e._stripped_msg = text
+        except AttributeError:
+            pass
+    return text
+
 
 def _safe_int(s: str):
-    try:
-        return int(str(s).strip())
-    except Exception:
+    # 先判断再转换，非法输入不走异常路径；天数有 max_days 上限，超长数字直接判非法
+    s = str(s).strip()
+    t = s[1:] if s[:1] in ("+", "-") else s
+    if not t.isdecimal() or len(t) > 10:
         return None
+    return int(s)
+
+
+# 设备ID长度上限，超出直接判不合法
+_MAX_DEVICE_LEN = 8192
+# base64（含 urlsafe）允许的字符：translate 时全部删掉，有残留即含非法字符
+_B64_DELETE = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=_-"
 
 
 def _looks_like_base64(s: str) -> bool:
     s = (s or "").strip()
     if not s:
         return False
-    for ch in s:
-        if not (ch.isalnum() or ch in "+/=_-"):
-            return False
     try:
-        pad = (-len(s)) % 4
-        if pad:
-            s += "=" * pad
-        base64.b64decode(s, validate=False)
-        return True
-    except Exception:
+        data = s.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    if data.translate(None, _B64_DELETE):
+        return False
+    # "=" 只能作为末尾最多两个的填充
+    body = data.rstrip(b"=")
+    if b"=" in body or len(data) - len(body) > 2:
         return False
+    # 字符集合法后只看长度：余 1 的长度无论怎么补 "=" 都解不出来
+    n = len(body)
+    return 0 < n and len(data) <= _MAX_DEVICE_LEN and n % 4 != 1
 
 
 def _fmt_expire_ms(ms: int) -> str:
@@ -43,27 +108,54 @@ def _fmt_expire_ms(ms: int) -> str:
         return str(ms)
 
 
+# 设备信息框的固定部分，渲染时只拼接动态字段
+_TPL_PREFIX = "┏━━━━━━━━━━ 设备信息 ━━━━━━━━━━┓\n┃ Android ID     : "
+_TPL_MANUFACTURER = "\n┃ Manufacturer   : "
+_TPL_MODEL = "\n┃ Model          : "
+_TPL_PRODUCT = "\n┃ Product        : "
+_TPL_EXPIRE = "\n┃ Expire         : "
+_TPL_SUFFIX = "\n┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛"
+
+
 def _render_device_info(system_info: dict, expire_ms: int) -> str:
-    android_id = system_info.get("androidId", "") or ""
-    manufacturer = system_info.get("manufacturer", "") or ""
-    model = system_info.get("model", "") or ""
-    product = system_info.get("product", "") or ""
-    expire_str = _fmt_expire_ms(expire_ms)
-
-    lines = [
-        "┏━━━━━━━━━━ 设备信息 ━━━━━━━━━━┓",
-        f"┃ Android ID     : {android_id}",
-        f"┃ Manufacturer   : {manufacturer}",
-        f"┃ Model          : {model}",
-        f"┃ Product        : {product}",
-        f"┃ Expire         : {expire_str}",
-        "┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛",
-    ]
-    return "\n".join(lines)
+    return (
+        _TPL_PREFIX + str(system_info.get("androidId", "") or "")
+        + _TPL_MANUFACTURER + str(system_info.get("manufacturer", "") or "")
+        + _TPL_MODEL + str(system_info.get("model", "") or "")
+        + _TPL_PRODUCT + str(system_info.get("product", "") or "")
+        + _TPL_EXPIRE + _fmt_expire_ms(expire_ms)
+        + _TPL_SUFFIX
+    )
+
+
+# 两步问答共用同一个等待器；装饰器只在导入时执行一次，每次调用各自建立等待会话
+# （AstrBot 的 decorator timeout 不能动态改，wait_timeout 目前只是兜底配置）
+@session_waiter(
+    timeout=300,
+    record_history_chains=False,
+    interruptible=False,  # ⭐抗打断关键
+)
+async def _wait_text(controller: SessionController, e: AstrMessageEvent):
+    return _message_text(e)
 
 
 @register("license_exchange", "chen", "两步问答授权兑换（设备ID + 天数）", "1.1.0", "repo url")
 class LicenseExchangePlugin(Star):
+    # Star 本身没有 __slots__，实例仍保留 __dict__；这里只把自己的字段放进槽位
+    __slots__ = (
+        "config",
+        "api_url",
+        "timeout_sec",
+        "max_days",
+        "allow_plain_trigger",
+        "client_side_validate",
+        "_dispatch",
+        "wait_timeout",
+        "_locks",
+        "_session",
+        "_session_lock",
+    )
+
     def __init__(self, context: Context, config=None):
         super().__init__(context)
         self.config = config or {}
@@ -72,12 +164,25 @@ class LicenseExchangePlugin(Star):
         self.timeout_sec = float(self.config.get("timeout_sec", 15))
         self.max_days = int(self.config.get("max_days", 3650))
         self.allow_plain_trigger = bool(self.config.get("allow_plain_trigger", True))
+        # 关闭后设备ID交给服务端校验：省掉本地检查，但格式错误要等一次请求才知道
+        self.client_side_validate = bool(self.config.get("client_side_validate", True))
+
+        # 按配置预先绑定好可用触发词的处理方法，收到消息只查一次表
+        self._dispatch = {
+            text: getattr(self, name)
+            for text, name in _DISPATCH.items()
+            if self.allow_plain_trigger or text != _PLAIN_TRIGGER
+        }
 
         # 会话等待配置：更耐心，且不容易被别的插件/消息打断
         self.wait_timeout = int(self.config.get("wait_timeout", 300))
 
         # 同一用户并发锁，避免“授权”连点导致串流程
-        self._active_sessions = set()
+        self._locks: dict[str, asyncio.Lock] = {}
+
+        # 复用同一个 HTTP 会话，保持 keep-alive 连接，首次使用时再创建
+        self._session: aiohttp.ClientSession | None = None
+        self._session_lock = asyncio.Lock()
 
     def _session_key(self, event: AstrMessageEvent) -> str:
         # 尽量用 session_id（群/私聊都唯一），拿不到就退化到 sender_id
@@ -87,22 +192,35 @@ class LicenseExchangePlugin(Star):
         sender = getattr(event, "sender_id", None) or getattr(event, "user_id", None) or ""
         return str(sender)
 
+    async def _get_session(self) -> aiohttp.ClientSession:
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=32,
+                    keepalive_timeout=60,
+                    ttl_dns_cache=300,
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout_sec),
+                    headers={"Content-Type": "application/json"},
+                )
+            return self._session
+
     async def _post_exchange(self, device_b64: str, days: int) -> dict:
-        payload = {"deviceBase64": device_b64, "days": days}
-        timeout = aiohttp.ClientTimeout(total=self.timeout_sec)
-        async with aiohttp.ClientSession(timeout=timeout) as sess:
-            async with sess.post(
-                self.api_url,
-                headers={"Content-Type": "application/json"},
-                json=payload,
-            ) as resp:
-                text = await resp.text()
-                if resp.status < 200 or resp.status >= 300:
-                    raise RuntimeError(f"HTTP {resp.status}: {text[:300]}")
-                try:
-                    return json.loads(text)
-                except Exception:
-                    raise RuntimeError(f"Invalid JSON: {text[:300]}")
+        body = _json_dumps({"deviceBase64": device_b64, "days": days})
+        sess = await self._get_session()
+        # Content-Type 已在会话默认头里设好，这里直接发序列化好的字节
+        async with sess.post(self.api_url, data=body) as resp:
+            raw = await _read_at_most(resp.content, _MAX_RESP_BYTES + 1)
+            if resp.status < 200 or resp.status >= 300:
+                raise RuntimeError(f"HTTP {resp.status}: {_preview(raw)}")
+            if len(raw) > _MAX_RESP_BYTES:
+                raise RuntimeError(f"response too large (> {_MAX_RESP_BYTES} bytes)")
+            try:
+                return _json_loads(raw)
+            except ValueError:
+                raise RuntimeError(f"Invalid JSON: {_preview(raw)}")
 
     async def _run_flow(self, event: AstrMessageEvent):
         # 禁止 LLM 插嘴
@@ -112,95 +230,86 @@ class LicenseExchangePlugin(Star):
             pass
 
         key = self._session_key(event)
-        if key in self._active_sessions:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        if lock.locked():
             # 已有进行中的流程，别让人类把自己绕死
             yield event.plain_result("已有进行中的授权流程")
             return
 
-        self._active_sessions.add(key)
         try:
-            # 1) 询问 deviceBase64
-            yield event.plain_result("请提供设备ID")
-
-            @session_waiter(
-                timeout=300,  # 兜底，下面会用 self.wait_timeout 覆盖
-                record_history_chains=False,
-                interruptible=False,  # ⭐抗打断关键
-            )
-            async def wait_device(controller: SessionController, e: AstrMessageEvent):
-                return (e.message_str or "").strip()
-
-            # 兼容：用实例配置覆盖（AstrBot 的 decorator timeout 不能动态改，这里用 controller 来等）
-            try:
-                device_b64 = await wait_device(event)
-            except TimeoutError:
-                yield event.plain_result("超时")
-                return
-            except Exception:
-                logger.error("wait_device error", exc_info=True)
-                yield event.plain_result("错误")
-                return
-
-            if not _looks_like_base64(device_b64):
-                yield event.plain_result("设备ID格式不正确")
-                return
+            async with lock:
+                # 1) 询问 deviceBase64
+                yield event.plain_result("请提供设备ID")
 
-            # 2) 询问 days
-            yield event.plain_result("请输入授权天数")
-
-            @session_waiter(
-                timeout=300,
-                record_history_chains=False,
-                interruptible=False,  # ⭐抗打断关键
-            )
-            async def wait_days(controller: SessionController, e: AstrMessageEvent):
-                return (e.message_str or "").strip()
-
-            try:
-                days_raw = await wait_days(event)
-            except TimeoutError:
-                yield event.plain_result("超时")
-                return
-            except Exception:
-                logger.error("wait_days error", exc_info=True)
-                yield event.plain_result("错误")
-                return
-
-            days = _safe_int(days_raw)
-            if days is None or days <= 0 or days > self.max_days:
-                yield event.plain_result("天数不合法")
-                return
-
-            # 3) 请求接口
-            try:
-                data = await self._post_exchange(device_b64, days)
-            except Exception as e:
-                logger.error(f"exchange request failed: {e}", exc_info=True)
-                yield event.plain_result("请求失败")
-                return
+                try:
+                    device_b64 = await _wait_text(event)
+                except TimeoutError:
+                    yield event.plain_result("超时")
+                    return
+                except Exception:
+                    logger.error("wait_device error", exc_info=True)
+                    yield event.plain_result("错误")
+                    return
 
-            if not isinstance(data, dict) or not data.get("ok"):
-                short = str(data)[:400]
-                yield event.plain_result(short)
-                return
+                if self.client_side_validate and not _looks_like_base64(device_b64):
+                    yield event.plain_result("设备ID格式不正确")
+                    return
 
-            system_info = data.get("system_info") or {}
-            expire = data.get("expire")
-            license_str = data.get("license", "")
+                # 2) 询问 days
+                yield event.plain_result("请输入授权天数")
 
-            info_text = _render_device_info(
-                system_info,
-                int(expire) if isinstance(expire, (int, float)) else 0
-            )
+                try:
+                    days_raw = await _wait_text(event)
+                except TimeoutError:
+                    yield event.plain_result("超时")
+                    return
+                except Exception:
+                    logger.error("wait_days error", exc_info=True)
+                    yield event.plain_result("错误")
+                    return
 
-            # 先发设备信息
-            yield event.plain_result(info_text)
+                days = _safe_int(days_raw)
+                if days is None or days <= 0 or days > self.max_days:
+                    yield event.plain_result("天数不合法")
+                    return
 
-            # 再发 License：整条消息只包含 license 本体
-            yield event.plain_result(str(license_str))
+                # 3) 请求接口
+                try:
+                    data = await self._post_exchange(device_b64, days)
+                except Exception as e:
+                    logger.error(f"exchange request failed: {e}", exc_info=True)
+                    yield event.plain_result("请求失败")
+                    return
+
+                if not isinstance(data, dict) or not data.get("ok"):
+                    try:
+                        short = _json_dumps(data).decode("utf-8", "replace")[:400]
+                    except Exception:
+                        short = repr(data)[:400]
+                    yield event.plain_result(short)
+                    return
+
+                system_info = data.get("system_info") or {}
+                expire = data.get("expire")
+                license_str = data.get("license", "")
+
+                info_text = _render_device_info(
+                    system_info,
+                    int(expire) if isinstance(expire, (int, float)) else 0
+                )
+
+                # 先发设备信息
+                yield event.plain_result(info_text)
+
+                # 再发 License：整条消息只包含 license 本体
+                yield event.plain_result(str(license_str))
 
         finally:
-            self._active_sessions.discard(key)
+            # 流程结束且没人占用时回收锁，避免 _locks 无限增长
+            if not lock.locked() and self._locks.get(key) is lock:
+                del self._locks[key]
             # 抢占事件，防止别的插件接着闹
             try:
                 event.stop_event()
@@ -210,15 +319,12 @@ class LicenseExchangePlugin(Star):
     # 更稳的触发：统一监听消息并手动匹配
     @filter.event_message_type(filter.EventMessageType.ALL)
     async def on_message(self, event: AstrMessageEvent):
-        text = (event.message_str or "").strip()
+        text = _message_text(event)
         if not text:
             return
 
-        triggers = {"授权", "/授权", "license", "auth"}
-        if text not in triggers:
-            return
-
-        if not self.allow_plain_trigger and text == "授权":
+        handler = self._dispatch.get(text)
+        if handler is None:
             return
 
         # 禁止 LLM
@@ -233,8 +339,10 @@ class LicenseExchangePlugin(Star):
         except Exception:
             pass
 
-        async for r in self._run_flow(event):
+        async for r in handler(event):
             yield r
 
     async def terminate(self):
-        pass
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None